@@ -3,37 +3,41 @@ import shutil
 import sys
 import warnings
 from contextlib import contextmanager
-from functools import partial
+from functools import lru_cache, partial
 from itertools import chain
+from pathlib import Path
 
 import pytest
-from giving import SourceProxy
-from ptera.utils import Named
-from rx.internal.exceptions import SequenceContainsNoElementsError
 
-_conftests = []
+_conftests = set()
 _summaries = {}
+_context_managers = {}
+_color_markups = {}
 
 
-_terminal_width = shutil.get_terminal_size((80, 20)).columns
+_terminal_width = None
 
 
-NO_ARGUMENT = Named("NO_ARGUMENT")
+def terminal_width():
+    global _terminal_width
+    if _terminal_width is None:
+        _terminal_width = shutil.get_terminal_size((80, 20)).columns
+    return _terminal_width
 
 
 class Summary:
+    __slots__ = ("_header", "_lines", "_footer", "_exit")
+
     def __init__(self):
         self._header = []
         self._lines = []
         self._footer = []
+        self._exit = None
 
     def title(self, title):
-        self.header(
-            "~" * _terminal_width,
-            title,
-            "~" * _terminal_width,
-        )
-        self.footer("~" * _terminal_width)
+        rule = "~" * terminal_width()
+        self.header(rule, title, rule)
+        self.footer(rule)
 
     def header(self, *lines):
         self._header += lines
@@ -49,7 +53,7 @@ class Summary:
                 item = d.pop("location")
                 (value,) = d.values()
                 value = str(value)
-                padding = _terminal_width - len(value)
+                padding = terminal_width() - len(value)
                 line = f"{item:{padding}}{value}"
         self._lines.append(line)
 
@@ -57,28 +61,65 @@ class Summary:
         self._footer += lines
 
     def dump(self):
-        for line in chain(self._header, self._lines, self._footer):
-            print(line)
+        lines = self._header + self._lines + self._footer
+        if lines:
+            sys.stdout.write("\n".join(map(str, lines)) + "\n")
+
+
+def as_context_manager(fn):
+    if not inspect.isgeneratorfunction(fn):
+        return fn
+    if fn not in _context_managers:
+        _context_managers[fn] = contextmanager(fn)
+    return _context_managers[fn]
 
 
 def require_summary(metrics, summary_function):
-    key = summary_function
     if summary_function not in _summaries:
-        if inspect.isgeneratorfunction(summary_function):
-            summary_function = contextmanager(summary_function)
         summary = Summary()
-        rval = summary_function(metrics, summary)
+        rval = as_context_manager(summary_function)(metrics, summary)
         if hasattr(rval, "__enter__"):
             rval.__enter__()
             summary._exit = rval
-        _summaries[key] = summary
+        _summaries[summary_function] = summary
+
+
+def _status_property(long, short, color, category):
+    return (
+        "ptera_status",
+        {
+            "category": category or long.lower(),
+            "long": long,
+            "short": short or long[0],
+            "color": color,
+        },
+    )
+
+
+def _status_do(reporter, prop, condition, done, x):
+    if not done and (condition is None or condition(x)):
+        reporter.item.user_properties.append(prop)
+        done.append(True)
+
+
+def _broadcast_do(buffer, location, key, value):
+    if key is None:
+        assert isinstance(value, dict) and len(value) == 1
+        ((metric, value),) = value.items()
+    else:
+        metric = key
+
+    if buffer is not None:
+        buffer.append({metric: value, "location": location})
 
 
 class Reporter:
-    def __init__(self, name, item):
+    __slots__ = ("name", "item", "broadcast_stream")
+
+    def __init__(self, name, item, broadcast_stream):
         self.name = name
         self.item = item
-        self.broadcast_stream = self.item.session.broadcast_stream
+        self.broadcast_stream = broadcast_stream
 
     def set_status(
         self,
@@ -88,15 +129,7 @@ class Reporter:
         category=None,
     ):
         self.item.user_properties.append(
-            (
-                "ptera_status",
-                {
-                    "category": category or long.lower(),
-                    "long": long,
-                    "short": short or long[0],
-                    "color": color,
-                },
-            )
+            _status_property(long, short, color, category)
         )
 
     def status(
@@ -107,34 +140,16 @@ class Reporter:
         category=None,
         condition=lambda x: x is not False,
     ):
-        done = False
-
-        def do(x):
-            nonlocal done
-            if not done and (condition is None or condition(x)):
-                self.set_status(
-                    long=long, short=short, color=color, category=category
-                )
-                done = True
-
-        return do
+        prop = _status_property(long, short, color, category)
+        return partial(_status_do, self, prop, condition, [])
 
     def broadcast(self, key=None, **data):
-        def do(value):
-            if key is None:
-                assert isinstance(value, dict) and len(value) == 1
-                ((metric, value),) = value.items()
-            else:
-                metric = key
-
-            if self.broadcast_stream:
-                filename, _, testname = self.item.location
-                self.broadcast_stream._push(
-                    {
-                        metric: value,
-                        "location": f"{filename}::{testname}",
-                    }
-                )
+        if self.broadcast_stream:
+            buffer = self.item._ptera_broadcasts
+            location = self.item._ptera_location
+        else:
+            buffer = location = None
+        do = partial(_broadcast_do, buffer, location, key)
 
         if key and not isinstance(key, str):
             raise TypeError("key argument should be a string")
@@ -169,42 +184,53 @@ class FunctionFinder:
     def __init__(self, prefix, default=None):
         self.prefix = prefix
         self.default = default
-        self.cache = {}
+        self.index = {}
+        self.resolve = lru_cache(maxsize=256)(self.resolve_uncached)
+
+    def clear(self):
+        self.resolve.cache_clear()
+
+    def register(self, pth, module):
+        prefix = f"{self.prefix}_"
+        for name, fn in vars(module).items():
+            if name.startswith(prefix) and fn is not None:
+                self.index.setdefault(name[len(prefix) :], {})[pth] = fn
+        self.clear()
 
     def find(self, sel):
-        if sel in self.cache:
-            return self.cache[sel]
+        if not isinstance(sel, str):
+            return {(): sel}
 
-        elif not isinstance(sel, str):
-            result = {(): sel}
+        elif sel.isidentifier():
+            return self.index.get(sel, {})
 
         elif "." in sel or "/" in sel:
             if self.default is None:
-                result = {}
+                return {}
             else:
-                result = {(): partial(self.default, sel)}
+                return {(): partial(self.default, sel)}
 
         elif "," in sel:
             result = {}
-            for sel in sel.split(","):
-                result.update(self.find(sel))
+            for part in sel.split(","):
+                result.update(self.find(part))
+            return result
 
         else:
-            result = {}
-            for cft in _conftests:
-                fn = getattr(cft, f"{self.prefix}_{sel}", None)
-                if fn is not None:
-                    result[tuple(cft.__name__.split(".")[:-1])] = fn
+            return self.index.get(sel, {})
 
-        self.cache[sel] = result
-        return result
-
-    def resolve(self, sel, module_path):
+    def resolve_uncached(self, sel, test_path):
         pros = self.find(sel)
-        for i in range(1, len(module_path) + 1):
-            pth = tuple(module_path[:-i])
-            if pth in pros:
-                return pros[pth]
+        # Pick the deepest conftest directory that contains the test file
+        result = None
+        depth = -1
+        for pth, fn in pros.items():
+            n = len(pth)
+            if depth < n < len(test_path) and test_path[:n] == pth:
+                result = fn
+                depth = n
+
+        return result
 
 
 def make_display_probe(sel, reporter):
@@ -219,44 +245,108 @@ _probe_finder = FunctionFinder(prefix="probe", default=make_display_probe)
 _summary_finder = FunctionFinder(prefix="summary", default=None)
 
 
+@lru_cache(maxsize=256)
+def setup_plan(test_path, selectors):
+    plan = []
+    for sel in selectors:
+        probe_fn = _probe_finder.resolve(sel, test_path)
+        summary_fn = _summary_finder.resolve(sel, test_path)
+        if not probe_fn and not summary_fn:
+            raise NameError(f"Could not find probe '{sel}'")
+        if probe_fn:
+            probe_fn = as_context_manager(probe_fn)
+        plan.append((sel, probe_fn, summary_fn))
+
+    return tuple(plan)
+
+
+def pytest_plugin_registered(plugin, manager):
+    # This hook is historic, so conftests that were registered before this
+    # plugin are replayed here as well
+    name = getattr(plugin, "__name__", None)
+    if not isinstance(name, str):
+        return
+    # Conftests outside of packages are all imported as "conftest", so they
+    # are told apart by their directory rather than by their module name
+    filename = getattr(plugin, "__file__", None)
+    if (
+        name.rpartition(".")[2] == "conftest"
+        and filename
+        and plugin not in _conftests
+    ):
+        _conftests.add(plugin)
+        pth = Path(filename).resolve().parent.parts
+        _probe_finder.register(pth, plugin)
+        _summary_finder.register(pth, plugin)
+        setup_plan.cache_clear()
+
+
 def pytest_sessionstart(session):
-    global _conftests
-    _conftests = [
-        mod
-        for name, mod in sys.modules.items()
-        if name.split(".")[-1] == "conftest"
-    ]
-    session.ptera_probes = tuple(session.config.option.probe or ())
-    session.broadcast_stream = SourceProxy()
-    session.broadcast_stream.__enter__()
+    session.ptera_probes = tuple(
+        dict.fromkeys(map(sys.intern, session.config.option.probe or ()))
+    )
+    session.ptera_useprobes = True
+    session.broadcast_stream = None
+
+
+def pytest_collection_finish(session):
+    session.ptera_useprobes = any(
+        item.get_closest_marker("useprobes") is not None
+        for item in session.items
+    )
+
+
+def require_broadcast_stream(session):
+    if session.broadcast_stream is None:
+        from giving import SourceProxy
+
+        session.broadcast_stream = SourceProxy()
+        session.broadcast_stream.__enter__()
+    return session.broadcast_stream
 
 
 def pytest_runtest_setup(item):
-    module_path = item.module.__name__.split(".")
-    active_probes = []
+    if not item.session.ptera_probes and not item.session.ptera_useprobes:
+        return
 
     selectors = item.session.ptera_probes
+    extra = []
     for mark in item.iter_markers(name="useprobes"):
         for arg in mark.args:
-            if isinstance(arg, (list, tuple, set, frozenset)):
-                selectors = selectors + tuple(arg)
+            if isinstance(arg, str):
+                extra.append(arg)
+            elif isinstance(arg, (list, tuple, set, frozenset)):
+                extra.extend(arg)
             else:
-                selectors = selectors + (arg,)
+                extra.append(arg)
 
-    selectors = list({sel: None for sel in selectors}.keys())
+    if extra:
+        selectors = tuple(dict.fromkeys(chain(selectors, extra)))
 
-    active_probes = []
-    for sel in selectors:
-        probe_fn = _probe_finder.resolve(sel, module_path)
-        summary_fn = _summary_finder.resolve(sel, module_path)
-        if not probe_fn and not summary_fn:
-            raise NameError(f"Could not find probe '{sel}'")
+    if not selectors:
+        return
+
+    mod = item.module
+    test_path = getattr(mod, "_ptera_test_path", None)
+    if test_path is None:
+        test_path = mod._ptera_test_path = Path(mod.__file__).resolve().parts
+
+    plan = setup_plan(test_path, selectors)
+    for _, _, summary_fn in plan:
         if summary_fn:
-            require_summary(item.session.broadcast_stream, summary_fn)
+            require_summary(require_broadcast_stream(item.session), summary_fn)
+
+    # The stream only exists once a summary listens to it; until then,
+    # reporters get None and drop what they broadcast
+    stream = item.session.broadcast_stream
+    item._ptera_broadcasts = []
+    filename, _, testname = item.location
+    item._ptera_location = f"{filename}::{testname}"
+
+    active_probes = []
+    for sel, probe_fn, _ in plan:
         if probe_fn:
-            if inspect.isgeneratorfunction(probe_fn):
-                probe_fn = contextmanager(probe_fn)
-            probe = probe_fn(Reporter(sel, item))
+            probe = probe_fn(Reporter(sel, item, stream))
             if not hasattr(probe, "__enter__"):
                 raise TypeError(
                     "Probe function should be a generator or context manager"
@@ -272,30 +362,50 @@ def pytest_runtest_setup(item):
 @pytest.hookimpl(hookwrapper=True)
 def pytest_runtest_call(item):
     yield
-    for pro in item._ptera_probes:
-        try:
-            pro.__exit__(None, None, None)
-        except SequenceContainsNoElementsError:
-            warnings.warn("A probe attempted a reduction with no elements")
+    probes = getattr(item, "_ptera_probes", ())
+    if not probes:
+        return
+
+    from rx.internal.exceptions import SequenceContainsNoElementsError
+
+    try:
+        for pro in probes:
+            try:
+                pro.__exit__(None, None, None)
+            except SequenceContainsNoElementsError:
+                warnings.warn("A probe attempted a reduction with no elements")
+    finally:
+        flush_broadcasts(item)
+
+
+def flush_broadcasts(item):
+    stream = item.session.broadcast_stream
+    for entry in item._ptera_broadcasts:
+        stream._push(entry)
+    item._ptera_broadcasts.clear()
 
 
 def pytest_report_teststatus(report, config):
-    if report.when == "call":
-        for name, value, *_ in report.user_properties:
-            if name == "ptera_status":
-                return (
-                    value["category"],
-                    value["short"],
-                    (value["long"], {value.get("color", "white"): True}),
-                )
+    if report.when != "call" or not report.user_properties:
+        return
+
+    for prop in report.user_properties:
+        if prop[0] == "ptera_status":
+            value = prop[1]
+            color = value.get("color", "white")
+            markup = _color_markups.get(color)
+            if markup is None:
+                markup = _color_markups[color] = {color: True}
+            return (value["category"], value["short"], (value["long"], markup))
 
 
 def pytest_sessionfinish(session, exitstatus):
-    session.broadcast_stream.__exit__(None, None, None)
+    if session.broadcast_stream is not None:
+        session.broadcast_stream.__exit__(None, None, None)
 
 
 def pytest_terminal_summary():
     for summ in _summaries.values():
-        if getattr(summ, "_exit", None):
+        if summ._exit:
             summ._exit.__exit__(None, None, None)
         summ.dump()
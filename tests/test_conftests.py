@@ -0,0 +1,58 @@
+import pytest
+
+ROOT_CONFTEST = """
+def probe_wow(reporter):
+    reporter.set_status("ROOTWOW")
+    yield
+"""
+
+SUB_CONFTEST = """
+def probe_wow(reporter):
+    reporter.set_status("SUBWOW")
+    yield
+"""
+
+TESTS = """
+def test_1():
+    pass
+
+def test_2():
+    pass
+"""
+
+
+@pytest.fixture
+def run(pytester, monkeypatch):
+    # The plugin is passed explicitly so it is not loaded twice when it is
+    # also installed as an entry point
+    monkeypatch.setenv("PYTEST_DISABLE_PLUGIN_AUTOLOAD", "1")
+
+    def run(*args):
+        return pytester.runpytest_subprocess("-p", "pytest_ptera.main", *args)
+
+    return run
+
+
+@pytest.mark.parametrize("packages", [False, True])
+def test_nested_conftests(pytester, run, packages):
+    pytester.makepyfile(
+        **{
+            "conftest": ROOT_CONFTEST,
+            "test_a": TESTS,
+            "sub/conftest": SUB_CONFTEST,
+            "sub/test_b": TESTS,
+        }
+    )
+    if packages:
+        pytester.makepyfile(**{"__init__": "", "sub/__init__": ""})
+
+    result = run("-P", "wow", "-v")
+    result.stdout.fnmatch_lines_random(
+        [
+            "*test_a.py::test_1 ROOTWOW*",
+            "*test_a.py::test_2 ROOTWOW*",
+            "*sub/test_b.py::test_1 SUBWOW*",
+            "*sub/test_b.py::test_2 SUBWOW*",
+        ]
+    )
+    result.stdout.no_fnmatch_line("*test_a.py::* SUBWOW*")